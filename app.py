@@ -1,7 +1,9 @@
 import streamlit as st
 from streamlit_gsheets import GSheetsConnection
 import pandas as pd
+import numpy as np
 import datetime
+import re
 import jpholiday
 import plotly.express as px
 
@@ -18,6 +20,12 @@ PSA_JAPAN_PLANS = {
     "Express":    {"business_days": 10, "price": 16980},
 }
 
+# PSA日本支社到着から鑑定開始までの待機期間
+_PSA_WAIT = datetime.timedelta(weeks=3)
+
+# ステータスの選択肢
+STATUS_OPTIONS = ["所有中", "鑑定中", "PSA提出準備", "売却済", "紛失/破損"]
+
 # 必須カラムの定義（エラー防止用）
 REQUIRED_COLUMNS = [
     "name", "model", "p_date", "p_price", 
@@ -28,28 +36,84 @@ REQUIRED_COLUMNS = [
 # ==========================================
 # 2. 関数群
 # ==========================================
+@st.cache_resource
+def _jp_holidays(years):
+    """指定年の祝日をまとめて frozenset にする（O(1)で判定するため）"""
+    s = set()
+    for y in years:
+        for d, _ in jpholiday.year_holidays(y):
+            s.add(d)
+    return frozenset(s)
+
+# 前年〜2年先の祝日はセッション開始時に一度だけ計算しておく
+_HOLIDAY_YEARS = tuple(range(datetime.date.today().year - 1, datetime.date.today().year + 3))
+_HOLIDAYS = _jp_holidays(_HOLIDAY_YEARS)
+
+def _holidays_between(first_date, last_date):
+    """期間内の祝日セットを返す（事前計算の範囲外なら追加で計算）"""
+    years = tuple(range(first_date.year, last_date.year + 1))
+    if all(y in _HOLIDAY_YEARS for y in years):
+        return _HOLIDAYS
+    return _jp_holidays(years)
+
+@st.cache_resource
+def _business_day_table(years):
+    """指定年の全日付と、各日までの累積営業日数のテーブルを作る"""
+    idx = pd.date_range(datetime.date(years[0], 1, 1), datetime.date(years[-1], 12, 31), freq="D")
+    holidays = _jp_holidays(years)
+    is_bday = (idx.weekday < 5) & ~np.array([d in holidays for d in idx.date])
+    return idx, np.cumsum(is_bday)
+
 def add_business_days(start_date, days_to_add):
-    """営業日計算"""
-    current_date = start_date
-    added_days = 0
-    while added_days < days_to_add:
-        current_date += datetime.timedelta(days=1)
-        is_weekend = current_date.weekday() >= 5
-        is_holiday = jpholiday.is_holiday(current_date)
-        if not is_weekend and not is_holiday:
-            added_days += 1
-    return current_date
+    """営業日計算（土日・祝日を除いて days_to_add 営業日後の日付を返す）"""
+    if days_to_add <= 0:
+        return start_date
+
+    # 事前計算した累積営業日数テーブルの範囲内なら二分探索で求める
+    idx, bday_count = _business_day_table(_HOLIDAY_YEARS)
+    i = idx.searchsorted(pd.Timestamp(start_date))
+    if i < len(idx) and idx[i] == pd.Timestamp(start_date):
+        j = np.searchsorted(bday_count, bday_count[i] + days_to_add)
+        if j < len(idx):
+            return idx[j].date()
+
+    # 範囲外の場合は候補日をまとめて生成し、平日かつ祝日でない日をマスクで数える
+    span = days_to_add * 2
+    while True:
+        candidate = pd.date_range(start_date + datetime.timedelta(days=1), periods=span, freq="D")
+        is_weekday = candidate.weekday.values < 5
+        holidays = _holidays_between(candidate[0], candidate[-1])
+        is_holiday = np.array([d in holidays for d in candidate.date])
+        business_count = np.cumsum(is_weekday & ~is_holiday)
+        if business_count[-1] >= days_to_add:
+            return candidate[business_count == days_to_add][0].date()
+        # 営業日が足りない場合は範囲を広げて再計算
+        span *= 2
 
+@st.cache_data(show_spinner=False)
 def calculate_psa(arrival_date, plan_name):
-    """PSA鑑定の返却予定日とコストを計算"""
+    """PSA鑑定のコストと返却予定日を (cost, return_date) のタプルで返す"""
     if plan_name not in PSA_JAPAN_PLANS:
-        return {"cost": 0, "return_date": None}
+        return (0, None)
     
     # 3週間の待機期間 + 営業日計算
-    processing_start = arrival_date + datetime.timedelta(weeks=3)
+    processing_start = arrival_date + _PSA_WAIT
     req_days = PSA_JAPAN_PLANS[plan_name]["business_days"]
     return_date = add_business_days(processing_start, req_days)
-    return {"cost": PSA_JAPAN_PLANS[plan_name]["price"], "return_date": return_date}
+    return (PSA_JAPAN_PLANS[plan_name]["price"], return_date)
+
+def _to_categorical(series, categories):
+    """既定の選択肢を先頭に並べたカテゴリ型へ変換する"""
+    extra = sorted(set(series.dropna()) - set(categories), key=str)
+    return pd.Categorical(series, categories=list(categories) + extra)
+
+def _to_price(series):
+    """数値に変換する。整数値だけなら int32 に縮め、小数を含む場合は float のまま残す"""
+    values = pd.to_numeric(series, errors='coerce').fillna(0)
+    arr = values.to_numpy(dtype='float64')
+    if (arr % 1 == 0).all() and np.abs(arr).max(initial=0) <= np.iinfo('int32').max:
+        return values.astype('int32')
+    return values.astype('float64')
 
 def ensure_columns(df):
     """必須カラムが不足している場合に補完し、型変換を行う"""
@@ -58,77 +122,193 @@ def ensure_columns(df):
         if col not in df.columns:
             df[col] = "" if col not in ["p_price", "psa_cost", "sale_price"] else 0
 
-    # 数値型への変換（エラー回避）
+    # 数値型への変換（エラー回避）。既に int32 なら変換しない
     num_cols = ['p_price', 'psa_cost', 'sale_price']
     for col in num_cols:
-        df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
+        if df[col].dtype != 'int32':
+            df[col] = _to_price(df[col])
     
     # 日付型への変換（表示用）
     date_cols = ['p_date', 'sub_date', 'ret_date', 'sale_date']
     for col in date_cols:
         df[col] = pd.to_datetime(df[col], errors='coerce')
 
+    # ステータスはカテゴリ型に（想定外の値も失わないよう末尾に追加）
+    # psa_plan は管理リストで自由入力できるよう文字列のまま残す
+    df['status'] = _to_categorical(df['status'], STATUS_OPTIONS)
+
     # 不要なカラム（Unnamedなど）を除去し、定義順に並べ替え
     return df[REQUIRED_COLUMNS]
 
+@st.cache_data(show_spinner=False)
+def with_derived(df):
+    """利益などの計算列を追加する（表示用）"""
+    df = df.copy()
+    df['total_cost'] = df['p_price'] + df['psa_cost']
+    df['profit'] = df['sale_price'] - df['total_cost']
+    # 売却済の場合は利益、未売却の場合は 0
+    df['profit_display'] = np.where(df['sale_price'] > 0, df['profit'], 0)
+    return df
+
+@st.cache_data(show_spinner=False)
+def build_pie(status_counts):
+    """ステータス別の円グラフを作成する（引数は (status, count) のタプル）"""
+    counts_df = pd.DataFrame(list(status_counts), columns=['status', 'count'])
+    return px.pie(counts_df, values='count', names='status', hole=0.4)
+
+@st.cache_data(show_spinner=False)
+def build_top5_bar(top5_records):
+    """高額カードの棒グラフを作成する（引数は (name, total_cost, model) のタプル）"""
+    top5_df = pd.DataFrame(list(top5_records), columns=['name', 'total_cost', 'model'])
+    return px.bar(top5_df, x='name', y='total_cost', color='model', title="保有カード原価")
+
 # ==========================================
 # 3. データ接続
 # ==========================================
 conn = st.connection("gsheets", type=GSheetsConnection)
 
+def _csv_export_url(sheet_url):
+    """スプレッドシートのURLからCSVエクスポート用のURLを組み立てる"""
+    m = re.search(r"/spreadsheets/d/([a-zA-Z0-9_-]+)", sheet_url)
+    if not m:
+        raise ValueError(f"public_gsheets_url がスプレッドシートのURLではありません: {sheet_url}")
+    # gid が無い場合は1枚目のシート（gid=0）
+    gid = re.search(r"[?#&]gid=(\d+)", sheet_url)
+    return f"https://docs.google.com/spreadsheets/d/{m.group(1)}/export?format=csv&gid={gid.group(1) if gid else 0}"
+
+def _read_sheet():
+    """スプレッドシートの生データを取得する（通信部分のみ）"""
+    public_url = st.secrets.get("public_gsheets_url")
+    if public_url:
+        # 公開シートはCSVエクスポートを直接読む（API認証を省略して高速化）
+        return pd.read_csv(_csv_export_url(public_url), dtype={'status': 'category'})
+    # worksheetを指定せず、1枚目のシートを読み込む（エラー回避）
+    return conn.read()
+
+class SheetReadError(Exception):
+    """スプレッドシートの読み込み（通信）に失敗したことを表す例外"""
+
+@st.cache_data(ttl=600, show_spinner=False)
 def load_data():
-    """データを読み込み、前処理を行う"""
+    """データを読み込み、前処理を行う（結果は10分間キャッシュ）"""
+    # 例外処理は通信部分だけに限定し、型変換の不具合は隠さない
+    # 読み込み失敗は例外として送出する（st.cache_data は例外をキャッシュしない）
     try:
-        # worksheetを指定せず、1枚目のシートを読み込む（エラー回避）
-        df = conn.read()
-        return ensure_columns(df)
+        df = _read_sheet()
     except Exception as e:
+        raise SheetReadError(e) from e
+    return ensure_columns(df)
+
+def try_load_data():
+    """データを読み込む。通信に失敗した場合はエラーを表示して None を返す"""
+    try:
+        return load_data()
+    except SheetReadError as e:
         st.error(f"データ読み込みエラー: {e}")
-        return pd.DataFrame(columns=REQUIRED_COLUMNS)
+        return None
 
 def update_data(df):
     """データフレーム全体をスプレッドシートに書き込む"""
     try:
         # 日付型を文字列に戻して保存（JSONシリアライズ対策）
-        save_df = df.copy()
+        # 全体をコピーせず、日付列だけを差し替えたフレームを作る
         date_cols = ['p_date', 'sub_date', 'ret_date', 'sale_date']
-        for col in date_cols:
-            save_df[col] = save_df[col].apply(lambda x: x.strftime('%Y-%m-%d') if pd.notnull(x) else "")
-            
+        save_df = df.assign(**{
+            col: pd.to_datetime(df[col], errors='coerce').dt.strftime('%Y-%m-%d').fillna("")
+            for col in date_cols
+        })
+
         conn.update(data=save_df)
         st.toast("✅ データを更新しました！", icon="💾")
         st.cache_data.clear() # キャッシュクリア
+        get_worksheet.clear() # シート全体を書き直したのでヘッダー行も取り直す
+    except Exception as e:
+        st.error(f"保存エラー: {e}")
+
+@st.cache_resource
+def get_worksheet():
+    """書き込み用に1枚目のワークシート（gspread）とヘッダー行を取得する（再実行をまたいで使い回す）"""
+    # conn.read() と同じ解決方法（コネクタ内部の _select_worksheet）で1枚目のシートを開く
+    ws = conn.client._select_worksheet()
+
+    # 空のシートにはヘッダー行を書き込む（データ行が1行目に入るのを防ぐ）
+    header = ws.row_values(1)
+    if not header:
+        ws.insert_row(REQUIRED_COLUMNS, 1)
+        header = list(REQUIRED_COLUMNS)
+
+    # ヘッダーに無い必須カラムは右端に追加する
+    for col in REQUIRED_COLUMNS:
+        if col not in header:
+            header.append(col)
+            ws.update_cell(1, len(header), col)
+    return ws, header
+
+def to_sheet_row(row, header):
+    """1行分のdictをヘッダー行の並びに合わせたセル値リストに変換する"""
+    values = []
+    for col in header:
+        value = row.get(col)
+        if value is None or (not isinstance(value, str) and pd.isnull(value)):
+            value = ""
+        elif isinstance(value, (datetime.date, pd.Timestamp)):
+            value = value.strftime('%Y-%m-%d')
+        values.append(value)
+    return values
+
+def _append_rows(rows):
+    """複数行をまとめてスプレッドシート末尾に追記する（全体の再書き込みを避ける）"""
+    try:
+        ws, header = get_worksheet()
+        ws.append_rows([to_sheet_row(r, header) for r in rows], value_input_option="USER_ENTERED")
+        st.toast("✅ データを追加しました！", icon="💾")
+        st.cache_data.clear() # キャッシュクリア
+        return True
     except Exception as e:
         st.error(f"保存エラー: {e}")
+        return False
+
+def append_data(row):
+    """1行を追記する。失敗した行は送信待ちバッファに残し、再送ボタンから送り直す"""
+    if _append_rows([row]):
+        return True
+    pending_rows = st.session_state.setdefault('pending_rows', [])
+    pending_rows.append(row)
+    st.warning(f"未送信として保持しました（{len(pending_rows)} 件）。再入力せず下の「未送信データを再送する」を押してください。")
+    return False
+
+def flush_pending_rows():
+    """送信待ちバッファの行をまとめて再送する"""
+    pending_rows = st.session_state.get('pending_rows', [])
+    if pending_rows and _append_rows(pending_rows):
+        pending_rows.clear()
 
 # ==========================================
 # 4. アプリ画面構成
 # ==========================================
 menu = st.sidebar.radio("メニュー", ["📊 ダッシュボード", "📝 カード登録", "🗂 管理リスト(編集)"])
 
-# データをロード
-df = load_data()
-
-# 利益などの計算列を追加（表示用）
-df['total_cost'] = df['p_price'] + df['psa_cost']
-df['profit'] = df['sale_price'] - df['total_cost']
-# 売却済の場合は利益、未売却の場合は「-」
-df['profit_display'] = df.apply(lambda x: x['profit'] if x['sale_price'] > 0 else 0, axis=1)
-
-
 if menu == "📊 ダッシュボード":
     st.title("📊 資産運用ダッシュボード")
+    # データをロードし、計算列を追加
+    df = try_load_data()
+    if df is None:
+        st.stop()
+    df = with_derived(df)
     
     if not df.empty:
         # --- KPIエリア ---
         col1, col2, col3 = st.columns(3)
         
+        # 売却済かどうかのマスクを一度だけ作る（カテゴリのコード同士で比較）
+        sold_mask = df['status'].cat.codes == df['status'].cat.categories.get_loc('売却済')
+
         # 保有資産（売却済以外）
-        holding_df = df[df['status'] != '売却済']
+        holding_df = df[~sold_mask]
         current_assets = holding_df['total_cost'].sum()
         
         # 確定利益（売却済のみ）
-        sold_df = df[df['status'] == '売却済']
+        sold_df = df[sold_mask]
         realized_profit = sold_df['profit'].sum()
         roi = (realized_profit / sold_df['total_cost'].sum() * 100) if not sold_df.empty else 0
 
@@ -143,16 +323,24 @@ if menu == "📊 ダッシュボード":
         
         with c1:
             st.subheader("ステータス別 内訳")
-            status_counts = df['status'].value_counts().reset_index()
-            status_counts.columns = ['status', 'count']
-            fig_pie = px.pie(status_counts, values='count', names='status', hole=0.4)
+            status_counts = df['status'].value_counts()
+            status_counts = status_counts[status_counts > 0] # 0件のカテゴリは除外
+            fig_pie = build_pie(tuple((str(k), int(v)) for k, v in status_counts.items()))
             st.plotly_chart(fig_pie, use_container_width=True)
 
         with c2:
             st.subheader("高額カード TOP5 (取得額)")
-            top5 = holding_df.nlargest(5, 'total_cost')
+            # 5番目に大きい値以上の行だけを候補にし、行順を保って並べ替える（nlargest と同じ結果）
+            costs = holding_df['total_cost'].to_numpy()
+            if len(costs) > 5:
+                kth = -np.partition(-costs, 4)[4]
+                idx = np.flatnonzero(costs >= kth)
+            else:
+                idx = np.arange(len(costs))
+            idx = idx[np.argsort(-costs[idx], kind='stable')][:5]
+            top5 = holding_df.iloc[idx]
             if not top5.empty:
-                fig_bar = px.bar(top5, x='name', y='total_cost', color='model', title="保有カード原価")
+                fig_bar = build_top5_bar(tuple(top5[['name', 'total_cost', 'model']].itertuples(index=False, name=None)))
                 st.plotly_chart(fig_bar, use_container_width=True)
             else:
                 st.info("保有中のカードがありません")
@@ -190,11 +378,11 @@ elif menu == "📝 カード登録":
                 st.error("カード名は必須です")
             else:
                 # PSA計算
-                psa_res = {"cost":0, "return_date":None}
+                psa_cost, return_date = 0, None
                 status = "所有中"
                 
                 if use_psa:
-                    psa_res = calculate_psa(sub_date, psa_plan)
+                    psa_cost, return_date = calculate_psa(sub_date, psa_plan)
                     status = "鑑定中"
                 
                 # 新規データ作成
@@ -205,26 +393,35 @@ elif menu == "📝 カード登録":
                     "p_price": p_price,
                     "psa_plan": psa_plan if use_psa else "",
                     "sub_date": sub_date if use_psa else None,
-                    "psa_cost": psa_res["cost"],
-                    "ret_date": psa_res["return_date"],
+                    "psa_cost": psa_cost,
+                    "ret_date": return_date,
                     "status": status,
                     "sale_date": None,
                     "sale_price": 0,
                     "memo": memo
                 }
                 
-                # データフレームに追加して保存
-                new_df = pd.DataFrame([new_row])
-                # 既存データと結合するために型合わせ
-                combined_df = pd.concat([df, ensure_columns(new_df)], ignore_index=True)
-                
-                update_data(combined_df)
-                st.success(f"「{name}」を登録しました！")
+                # 新しい行だけをシート末尾に追記（失敗時は送信待ちとして保持）
+                if append_data(new_row):
+                    st.success(f"「{name}」を登録しました！")
+
+    # 保存に失敗した行があれば件数を表示し、ボタンで再送する（フォーム処理の後に描画して即時反映）
+    if st.session_state.get('pending_rows'):
+        if st.button("🔁 未送信データを再送する"):
+            flush_pending_rows()
+        if st.session_state['pending_rows']:
+            st.warning(f"⚠️ 未送信の登録データが {len(st.session_state['pending_rows'])} 件あります（再入力は不要です）")
 
 
 elif menu == "🗂 管理リスト(編集)":
     st.title("🗂 データ管理・編集")
     st.caption("👇 表のセルをダブルクリックすると直接編集できます。「売却済」にする場合はステータスを変更し、売値を入れてください。")
+    # データをロードし、計算列を追加
+    # 読み込みに失敗した場合は、空の表でシートを上書き保存しないようここで止める
+    df = try_load_data()
+    if df is None:
+        st.stop()
+    df = with_derived(df)
 
     # 編集用データフレーム設定
     edited_df = st.data_editor(
@@ -240,7 +437,7 @@ elif menu == "🗂 管理リスト(編集)":
             "sale_date": st.column_config.DateColumn("売却日"),
             "status": st.column_config.SelectboxColumn(
                 "状態",
-                options=["所有中", "鑑定中", "PSA提出準備", "売却済", "紛失/破損"],
+                options=STATUS_OPTIONS,
                 required=True
             ),
             "profit": st.column_config.NumberColumn("想定利益", format="¥%d", disabled=True), # 計算結果は編集不可